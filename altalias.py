@@ -13,14 +13,22 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Set, Type, Dict, NamedTuple, Pattern, List, Optional
-from types import FrameType
-from contextlib import contextmanager
-import signal
+from typing import FrozenSet, Set, Type, Dict, Pattern, List, Optional, Tuple
+from functools import lru_cache
+import asyncio
 import html
+import sys
 import re
 
-from mautrix.types import RoomID, RoomAlias, EventType, CanonicalAliasStateEventContent
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# google-re2's error type isn't a subclass of re.error
+regex_errors = (re.error,) if re2 is None else (re.error, re2.error)
+
+from mautrix.types import RoomID, RoomAlias, UserID, EventType, CanonicalAliasStateEventContent
 from mautrix.errors import MNotFound, MForbidden, MatrixRequestError
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
@@ -28,8 +36,33 @@ from maubot import Plugin, MessageEvent
 from maubot.handlers import command
 
 
-class RoomInfo(NamedTuple):
-    formats: List[Pattern]
+class RoomInfo:
+    __slots__ = ("formats", "compiled", "patterns", "combined", "backtracking", "escaped_items")
+
+    formats: List[str]
+    compiled: bool
+    patterns: List[Pattern]
+    combined: Optional[Pattern]
+    backtracking: bool
+    escaped_items: List[str]
+
+    def __init__(self, formats: List[str]) -> None:
+        self.formats = formats
+        self.update()
+
+    def update(self) -> None:
+        self.compiled = False
+        self.patterns = []
+        self.combined = None
+        self.backtracking = False
+        self.escaped_items = [f"<li><code>{html.escape(pattern)}</code></li>"
+                              for pattern in self.formats]
+
+
+class AliasCheckError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+        self.message = message
 
 
 class Config(BaseProxyConfig):
@@ -40,40 +73,214 @@ class Config(BaseProxyConfig):
         helper.copy("rooms")
 
 
-def raise_timeout(sig: signal.Signals, frame_type: FrameType) -> None:
-    raise TimeoutError()
+localpart_regex = re.compile(r"#([^:]+):.+", re.DOTALL)
+quantifier_regex = re.compile(r"(?:([*+?])|\{(\d*)(,?)(\d*)\})[?+]?")
+group_start_regex = re.compile(r"\((?:\?(?:P<\w+>|<[=!]|[:=!>]|[aiLmsux-]*:|\(\w+\)))?")
+inline_token_regex = re.compile(r"\(\?(?:[aiLmsux-]+\)|#[^)]*\)|P=\w+\))")
+# The stdlib matcher holds the GIL until it's done, so it can't be timed out from a thread.
+# Formats that need it are matched in a subprocess instead, which can be killed.
+fallback_match_script = "import re, sys; sys.exit(0 if re.fullmatch(*sys.argv[1:3]) else 1)"
+
+
+@lru_cache(maxsize=512)
+def compile_format(pattern: str) -> Pattern:
+    # re2 matches in linear time, but doesn't support things like backreferences or lookarounds.
+    # Note that unlike the stdlib engine, re2's \w, \d and \b only match ASCII.
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass
+    return re.compile(pattern)
+
+
+class _GroupScan:
+    __slots__ = ("starts", "at_branch_start", "branch_mandatory", "mandatory", "variable",
+                 "overlap")
+
+    def __init__(self) -> None:
+        self.starts: List[Optional[str]] = []
+        self.at_branch_start = True
+        self.branch_mandatory = False
+        self.mandatory = True
+        self.variable = False
+        self.overlap = False
+
+    def add_atom(self, start: Optional[str], min_count: int, max_count: Optional[int],
+                 mandatory: bool = True, variable: bool = False, overlap: bool = False) -> None:
+        if self.at_branch_start:
+            self.starts.append(start if min_count > 0 else None)
+            self.at_branch_start = False
+        if max_count != min_count or (variable and max_count != 0):
+            self.variable = True
+        if mandatory and min_count > 0 and max_count == min_count:
+            self.branch_mandatory = True
+        if overlap and min_count == max_count == 1:
+            self.overlap = True
+
+    def end_branch(self) -> None:
+        if self.at_branch_start:
+            self.starts.append(None)
+        self.mandatory = self.mandatory and self.branch_mandatory
+        self.at_branch_start = True
+        self.branch_mandatory = False
 
+    def end(self) -> None:
+        self.end_branch()
+        if len(self.starts) > 1 and (None in self.starts
+                                     or len(set(self.starts)) < len(self.starts)):
+            self.overlap = True
 
-@contextmanager
-def timeout(time: float = 1) -> None:
-    signal.signal(signal.SIGALRM, raise_timeout)
-    signal.setitimer(signal.ITIMER_REAL, time)
+
+def _parse_quantifier(pattern: str, pos: int) -> Tuple[int, Optional[int], int]:
+    match = quantifier_regex.match(pattern, pos)
+    if not match:
+        return 1, 1, pos
+    simple, min_count, comma, max_count = match.groups()
+    if simple == "*":
+        return 0, None, match.end()
+    elif simple == "+":
+        return 1, None, match.end()
+    elif simple == "?":
+        return 0, 1, match.end()
+    elif not min_count and not max_count:
+        return 1, 1, pos
+    elif not comma:
+        return int(min_count), int(min_count), match.end()
+    return int(min_count or 0), int(max_count) if max_count else None, match.end()
+
+
+def looks_dangerous(pattern: str) -> bool:
+    # Flags repeated groups that can match the same text in more than one way, which is what makes
+    # the stdlib engine backtrack exponentially: groups made only of variable-length repetition,
+    # like (a+)+ or (\w+\s?)*, and groups with overlapping alternatives, like (a|aa)+.
+    stack = [_GroupScan()]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        group = stack[-1]
+        if char == "(":
+            match = inline_token_regex.match(pattern, i)
+            if match:
+                if match.group(0).startswith("(?P="):
+                    min_count, max_count, i = _parse_quantifier(pattern, match.end())
+                    group.add_atom(None, min_count, max_count)
+                else:
+                    i = match.end()
+                continue
+            stack.append(_GroupScan())
+            i = group_start_regex.match(pattern, i).end()
+            continue
+        elif char == ")" and len(stack) > 1:
+            stack.pop()
+            group.end()
+            min_count, max_count, i = _parse_quantifier(pattern, i + 1)
+            if ((max_count is None or max_count > 1)
+                    and (group.overlap or (group.variable and not group.mandatory))):
+                return True
+            stack[-1].add_atom(group.starts[0] if len(group.starts) == 1 else None,
+                               min_count, max_count, mandatory=group.mandatory,
+                               variable=group.variable, overlap=group.overlap)
+            continue
+        elif char == "|":
+            group.end_branch()
+            i += 1
+            continue
+        elif char in "^$":
+            i += 1
+            continue
+        elif char == "\\":
+            escaped = pattern[i + 1:i + 2]
+            i += 2
+            if escaped in ("A", "Z", "b", "B"):
+                continue
+            start = None if escaped.isalnum() else escaped
+        elif char == "[":
+            i += 1
+            if pattern[i:i + 1] == "^":
+                i += 1
+            if pattern[i:i + 1] == "]":
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+            start = None
+        else:
+            i += 1
+            start = None if char == "." else char
+        min_count, max_count, i = _parse_quantifier(pattern, i)
+        group.add_atom(start, min_count, max_count)
+    return False
+
+
+def combine_formats(formats: List[Pattern]) -> Optional[Pattern]:
+    if not formats:
+        return None
+    source = "|".join(f"(?:{regex.pattern})" for regex in formats)
     try:
-        yield
-    finally:
-        signal.alarm(0)
+        if re2 is not None and not any(isinstance(regex, re.Pattern) for regex in formats):
+            return re2.compile(rf"\A(?:{source})\z")
+        # Backreferences are numbered across the whole alternation and inline flags apply to
+        # all of it, so only combine stdlib patterns that have neither.
+        elif all(isinstance(regex, re.Pattern) and regex.flags == formats[0].flags
+                 and (len(formats) == 1 or regex.groups == 0) for regex in formats):
+            combined = re.compile(rf"\A(?:{source})\Z")
+            if combined.flags == formats[0].flags:
+                return combined
+    except regex_errors:
+        pass
+    return None
+
+
+def _match_alias(self: 'AltAliasBot', val: str) -> bool:
+    return val in self._aliases
 
 
 class AltAliasBot(Plugin):
     _command: str
-    _aliases: Set[str]
+    _aliases: FrozenSet[str]
+    _require_lowercase: bool
+    _admins: FrozenSet[UserID]
     _rooms: Dict[RoomID, RoomInfo]
+    _save_task: Optional[asyncio.Task]
+    _unsaved_formats: Dict[RoomID, List[str]]
 
     async def start(self) -> None:
+        self._save_task = None
+        self._unsaved_formats = {}
+        self._rooms = {}
         self.on_external_config_update()
 
+    async def stop(self) -> None:
+        if self._save_task and not self._save_task.done():
+            self._save_task.cancel()
+            self.save_rooms()
+
     def on_external_config_update(self) -> None:
         self.config.load_and_update()
-        self._command = self.config["command"][0]
-        self._aliases = set(self.config["command"])
-        self._rooms = {}
+        self._command = sys.intern(self.config["command"][0])
+        self._aliases = frozenset(sys.intern(alias) for alias in self.config["command"])
+        self._require_lowercase = bool(self.config["require_lowercase"])
+        self._admins = frozenset(self.config["admins"])
+        old_rooms, self._rooms = self._rooms, {}
         for room_id, info in self.config["rooms"].items():
-            self._rooms[room_id] = RoomInfo(formats=[])
-            for pattern in info.get("formats", []):
-                try:
-                    self._rooms[room_id].formats.append(re.compile(pattern))
-                except re.error:
-                    self.log.warning("Failed to compile pattern %s in room %s", pattern, room_id)
+            formats = list(info.get("formats", []))
+            old_room = old_rooms.get(room_id)
+            if old_room and old_room.formats == formats:
+                self._rooms[room_id] = old_room
+            else:
+                self._rooms[room_id] = RoomInfo(formats=formats)
+        # Formats added while a save is pending aren't in the reloaded config yet, so carry them
+        # over to make sure the pending save doesn't drop them.
+        for room_id, formats in self._unsaved_formats.items():
+            room = self._rooms.get(room_id)
+            if room is None:
+                self._rooms[room_id] = RoomInfo(formats=list(formats))
+                continue
+            missing = [pattern for pattern in formats if pattern not in room.formats]
+            if missing:
+                room.formats.extend(missing)
+                room.update()
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
@@ -82,94 +289,127 @@ class AltAliasBot(Plugin):
     def save_rooms(self) -> None:
         self.config["rooms"] = {
             room_id: {
-                "formats": [regex.pattern for regex in info.formats]
+                "formats": list(info.formats)
             } for room_id, info in self._rooms.items()
         }
         self.config.save()
+        self._unsaved_formats = {}
+
+    def _schedule_save(self) -> None:
+        if self._save_task and not self._save_task.done():
+            self._save_task.cancel()
+        self._save_task = asyncio.create_task(self._delayed_save(0.5))
 
-    @command.new(lambda self: self._command, aliases=lambda self, val: val in self._aliases,
+    async def _delayed_save(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        try:
+            self.save_rooms()
+        except Exception:
+            self.log.exception("Failed to save allowed alias formats")
+
+    @command.new(lambda self: self._command, aliases=_match_alias,
                  help="Manage alternate aliases")
     async def altalias(self, evt: MessageEvent) -> None:
         pass
 
     @staticmethod
     def _get_localpart(alias: RoomAlias) -> str:
-        if len(alias) == 0:
-            raise ValueError("Alias is empty")
-        elif alias[0] != "#":
-            raise ValueError("Aliases start with #")
-        try:
-            sep = alias.index(":")
-        except ValueError as e:
-            raise ValueError("Alias must contain domain separator") from e
-        if sep == len(alias) - 1:
-            raise ValueError("Alias must contain domain")
-        return alias[1:sep]
+        match = localpart_regex.fullmatch(alias)
+        if not match:
+            raise ValueError("Aliases must be in the format #localpart:domain")
+        return match.group(1)
 
     @classmethod
-    def _localpart_matches(cls, alias: RoomAlias, equal_to: str) -> bool:
-        try:
-            localpart = cls._get_localpart(alias)
-            if equal_to == localpart:
-                return True
-        except ValueError:
-            pass
-        return False
+    def _get_existing_localparts(cls, existing_event: CanonicalAliasStateEventContent
+                                 ) -> Set[str]:
+        localparts = set()
+        for alias in (existing_event.canonical_alias, *(existing_event.alt_aliases or [])):
+            if not alias:
+                continue
+            try:
+                localparts.add(cls._get_localpart(alias))
+            except ValueError:
+                pass
+        return localparts
 
     async def _validate_alias(self, evt: MessageEvent, alias: RoomAlias) -> bool:
+        if len(alias.encode("utf-8", errors="surrogatepass")) > 255:
+            await evt.reply("That alias is too long")
+            return False
         try:
             localpart = self._get_localpart(alias)
         except ValueError:
             await evt.reply("That is not a valid room alias")
             return False
-        if not localpart.islower() and self.config["require_lowercase"]:
+        if self._require_lowercase and not localpart.islower():
             await evt.reply("That alias localpart is not in lowercase")
             return False
+        return True
 
+    async def _check_alias_target(self, room_id: RoomID, alias: RoomAlias) -> None:
         try:
             alias_info = await self.client.get_room_alias(alias)
         except MNotFound:
-            await evt.reply("That alias does not exist")
+            raise AliasCheckError("That alias does not exist")
         except Exception:
-            await evt.reply("Failed to get alias info")
-        else:
-            if alias_info.room_id == evt.room_id:
-                return True
-            await evt.reply("That alias does not point to this room")
-        return False
+            raise AliasCheckError("Failed to get alias info")
+        if alias_info.room_id != room_id:
+            raise AliasCheckError("That alias does not point to this room")
 
-    async def _get_existing_aliases(self, evt: MessageEvent
-                                    ) -> Optional[CanonicalAliasStateEventContent]:
+    async def _get_existing_aliases(self, room_id: RoomID) -> CanonicalAliasStateEventContent:
         try:
-            existing_event = await self.client.get_state_event(evt.room_id,
-                                                               EventType.ROOM_CANONICAL_ALIAS)
+            return await self.client.get_state_event(room_id, EventType.ROOM_CANONICAL_ALIAS)
         except MNotFound:
-            existing_event = CanonicalAliasStateEventContent()
+            return CanonicalAliasStateEventContent()
         except MatrixRequestError as e:
-            await evt.reply(f"Failed to get current aliases: {e.message}")
-            return None
+            raise AliasCheckError(f"Failed to get current aliases: {e.message}")
         except Exception:
-            self.log.exception(f"Failed to get m.room.canonical_alias in {evt.room_id}")
-            await evt.reply("Failed to get current aliases (see logs for more details)")
-            return None
-        return existing_event
+            self.log.exception(f"Failed to get m.room.canonical_alias in {room_id}")
+            raise AliasCheckError("Failed to get current aliases (see logs for more details)")
 
-    def _is_allowed(self, room_id: RoomID, alias: RoomAlias,
-                    existing_event: CanonicalAliasStateEventContent) -> bool:
+    async def _match(self, room_id: RoomID, regex: Pattern, alias: RoomAlias,
+                     anchored: bool = False) -> bool:
+        if not isinstance(regex, re.Pattern):
+            return bool((regex.match if anchored else regex.fullmatch)(alias))
         try:
-            cfg = self._rooms[room_id]
-        except KeyError:
-            localpart = self._get_localpart(alias)
-            if self._localpart_matches(existing_event.canonical_alias, localpart):
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-I", "-S", "-c", fallback_match_script, regex.pattern, alias,
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+        except (OSError, ValueError) as e:
+            self.log.warning("Failed to start matcher for %s against %s in %s: %s",
+                             alias, regex.pattern, room_id, e)
+            return False
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout=2) == 0
+        except asyncio.TimeoutError:
+            self.log.warning("Timed out matching %s against %s in %s",
+                             alias, regex.pattern, room_id)
+            return False
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+
+    def _compile_formats(self, room_id: RoomID, cfg: RoomInfo) -> None:
+        if cfg.compiled:
+            return
+        cfg.patterns = []
+        for pattern in cfg.formats:
+            try:
+                cfg.patterns.append(compile_format(pattern))
+            except re.error:
+                self.log.warning("Failed to compile pattern %s in room %s", pattern, room_id)
+        cfg.combined = combine_formats(cfg.patterns)
+        cfg.backtracking = any(isinstance(regex, re.Pattern) for regex in cfg.patterns)
+        cfg.compiled = True
+
+    async def _matches_formats(self, room_id: RoomID, cfg: RoomInfo, alias: RoomAlias) -> bool:
+        self._compile_formats(room_id, cfg)
+        if cfg.combined is not None:
+            return await self._match(room_id, cfg.combined, alias, anchored=True)
+        for regex in cfg.patterns:
+            if await self._match(room_id, regex, alias):
                 return True
-            for existing_alias in existing_event.alt_aliases:
-                if self._localpart_matches(existing_alias, localpart):
-                    return True
-        else:
-            with timeout(max(len(cfg.formats) * 0.5, 2)):
-                for regex in cfg.formats:
-                    if regex.fullmatch(alias):
-                        return True
         return False
 
     async def _publish_aliases(self, evt: MessageEvent, alias: str,
@@ -192,15 +432,39 @@ class AltAliasBot(Plugin):
     async def add_alias(self, evt: MessageEvent, alias: RoomAlias) -> None:
         if not await self._validate_alias(evt, alias):
             return
+        room = self._rooms.get(evt.room_id)
+        if room is not None:
+            self._compile_formats(evt.room_id, room)
+            # Formats that need the backtracking engine only run on aliases that are known to
+            # point to this room, not on arbitrary user input.
+            if not room.backtracking and not await self._matches_formats(evt.room_id, room, alias):
+                await evt.reply("That alias is not allowed in this room")
+                return
 
-        existing_content = await self._get_existing_aliases(evt)
-        if existing_content is None:
-            return
-        elif alias in existing_content.alt_aliases:
+        results = await asyncio.gather(self._check_alias_target(evt.room_id, alias),
+                                       self._get_existing_aliases(evt.room_id),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, AliasCheckError):
+                await evt.reply(result.message)
+                return
+            elif isinstance(result, BaseException):
+                raise result
+        _, existing_content = results
+        if existing_content.alt_aliases is None:
+            existing_content.alt_aliases = []
+        if alias in existing_content.alt_aliases:
             await evt.reply("That alias is already published in this room")
             return
 
-        if not self._is_allowed(evt.room_id, alias, existing_content):
+        if room is None:
+            localpart = self._get_localpart(alias)
+            allowed = localpart in self._get_existing_localparts(existing_content)
+        elif room.backtracking:
+            allowed = await self._matches_formats(evt.room_id, room, alias)
+        else:
+            allowed = True
+        if not allowed:
             await evt.reply("That alias is not allowed in this room")
             return
 
@@ -209,19 +473,33 @@ class AltAliasBot(Plugin):
     @altalias.subcommand("allow", help="Add a regex for matching allowed alternate aliases")
     @command.argument("regex", pass_raw=True, required=True)
     async def allow_format(self, evt: MessageEvent, regex: str) -> None:
-        if evt.sender not in self.config["admins"]:
+        if evt.sender not in self._admins:
             powers = await self.client.get_state_event(evt.room_id, EventType.ROOM_POWER_LEVELS)
             if (powers.get_user_level(evt.sender)
                     < powers.get_event_level(EventType.ROOM_CANONICAL_ALIAS)):
                 await evt.reply("You don't have the permission to manage aliases in this room")
                 return
+        room = self._rooms.get(evt.room_id)
+        if room and regex in room.formats:
+            await evt.reply(f"<code>{html.escape(regex)}</code> is already an allowed alias format",
+                            allow_html=True, markdown=False)
+            return
         try:
-            room = self._rooms[evt.room_id]
-        except KeyError:
-            room = RoomInfo(formats=[])
-            self._rooms[evt.room_id] = room
-        room.formats.append(re.compile(regex))
-        self.save_rooms()
+            compiled = compile_format(regex)
+        except re.error as e:
+            await evt.reply(f"That is not a valid regex: {e}")
+            return
+        if isinstance(compiled, re.Pattern) and looks_dangerous(regex):
+            await evt.reply("That regex has repetition or alternatives that could make matching "
+                            "extremely slow")
+            return
+        if room is None:
+            self._rooms[evt.room_id] = RoomInfo(formats=[regex])
+        else:
+            room.formats.append(regex)
+            room.update()
+        self._unsaved_formats.setdefault(evt.room_id, []).append(regex)
+        self._schedule_save()
         await evt.reply(f"Added <code>{html.escape(regex)}</code> as an allowed alias format",
                         allow_html=True, markdown=False)
 
@@ -233,8 +511,7 @@ class AltAliasBot(Plugin):
             await evt.reply("This room does not have special alias rules. Aliases with the same "
                             "localpart as any of the existing aliases can be published.")
         else:
-            allowed = "".join(f"<li><code>{html.escape(regex.pattern)}</code></li>"
-                              for regex in room.formats)
+            allowed = "".join(room.escaped_items)
             await evt.reply("<p>This room allows aliases matching "
                             "the following regular expressions:</p>"
                             f"<ul>{allowed}</ul>", markdown=False, allow_html=True)